@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.simple import SimpleVectorStoreData
+from llama_index.core.vector_stores.types import VectorStoreQuery
+
+from projects.snapshots import load_snapshot
+from projects.vector_store import (
+    QuantizedVectorStore,
+    get_vectors,
+    load_vector_store,
+    store_data,
+)
+
+
+def dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def synthetic_embeddings(count, dim, seed):
+    """Clustered unit vectors, roughly shaped like chunks of a few documents."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, count // 50), dim))
+    vectors = centers[rng.integers(len(centers), size=count)]
+    vectors = vectors + rng.normal(scale=0.8, size=(count, dim))
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype(np.float32)
+
+
+def rss_bytes():
+    """Anonymous and file-backed resident memory of this process (Linux)."""
+    with open("/proc/self/status") as f:
+        fields = dict(line.split(":", 1) for line in f)
+    return np.array(
+        [int(fields[name].split()[0]) * 1024 for name in ("RssAnon", "RssFile")]
+    )
+
+
+def measure_store(conn, store_cls, persist_path, kwargs, node_ids, vectors, queries, top_k):
+    """Load one store and run the queries, in a child process."""
+    rss = rss_bytes()
+    start = time.perf_counter()
+    if store_cls is None:
+        # full precision matrix held in RAM, no memory mapping
+        store = QuantizedVectorStore.from_arrays(
+            SimpleVectorStoreData(), node_ids, np.array(vectors), **kwargs
+        )
+    else:
+        store = store_cls.from_persist_path(persist_path, **kwargs)
+    load_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    results = [
+        store.query(
+            VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k)
+        ).ids
+        for query in queries
+    ]
+    elapsed = (time.perf_counter() - start) * 1000 / len(queries)
+    conn.send((rss_bytes() - rss, load_ms, elapsed, results))
+    conn.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare float16 / int8 vector stores against full precision: memory, "
+        "disk and recall@k of the chat retrieval."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--persist-dir", default="./storage")
+        parser.add_argument(
+            "--synthetic",
+            type=int,
+            default=0,
+            help="Benchmark N synthetic 1536-d embeddings instead of the persisted index.",
+        )
+        parser.add_argument("--queries", type=int, default=100)
+        parser.add_argument("--top-k", type=int, default=10)
+        parser.add_argument("--rescore-factor", type=int, default=4)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--snapshot",
+            help="Only time loading this project snapshot, as a replica's first chat would.",
+        )
+
+    def time_snapshot(self, path):
+        start = time.perf_counter()
+        index = load_snapshot(path)
+        load_ms = (time.perf_counter() - start) * 1000
+        self.stdout.write(
+            f"{len(index.docstore.docs)} nodes, "
+            f"{len(index.index_struct.nodes_dict)} vectors loaded in {load_ms:.1f} ms"
+        )
+
+    def handle(self, *args, **options):
+        if options["snapshot"]:
+            self.time_snapshot(options["snapshot"])
+            return
+        if options["synthetic"]:
+            vectors = synthetic_embeddings(options["synthetic"], 1536, options["seed"])
+            node_ids = [f"node-{i}" for i in range(len(vectors))]
+        else:
+            store = load_vector_store(options["persist_dir"])
+            if isinstance(store, QuantizedVectorStore):
+                node_ids = list(store.node_ids)
+            else:
+                node_ids = list(store_data(store).embedding_dict)
+            vectors = get_vectors(store, node_ids)
+        if not len(node_ids):
+            self.stderr.write("No embeddings to benchmark.")
+            return
+
+        # queries: stored chunks with noise, as a stand-in for user prompts
+        rng = np.random.default_rng(options["seed"] + 1)
+        picks = rng.integers(len(vectors), size=options["queries"])
+        queries = vectors[picks] + rng.normal(
+            scale=0.5 / np.sqrt(vectors.shape[1]), size=(len(picks), vectors.shape[1])
+        )
+        top_k = options["top_k"]
+
+        data = SimpleVectorStoreData(
+            embedding_dict=dict(zip(node_ids, vectors.tolist())),
+            text_id_to_ref_doc_id={node_id: "None" for node_id in node_ids},
+        )
+        configs = [
+            ("float32 json", SimpleVectorStore, {}),
+            ("float32 ram", None, {"dtype": "float32"}),
+            ("float32 mmap", QuantizedVectorStore, {"dtype": "float32"}),
+        ]
+        for dtype in ("float16", "int8"):
+            for factor in sorted({1, options["rescore_factor"]}):
+                configs.append(
+                    (
+                        f"{dtype} x{factor}",
+                        QuantizedVectorStore,
+                        {"dtype": dtype, "rescore_factor": factor},
+                    )
+                )
+
+        exact = None
+        self.stdout.write(
+            f"{len(node_ids)} vectors x {vectors.shape[1]} dims "
+            f"({vectors.nbytes / 2**20:.2f} MB as raw float32), "
+            f"{len(queries)} queries, recall@{top_k}"
+        )
+        self.stdout.write(
+            f"{'store':<14}{'anon MB':>9}{'file MB':>9}{'disk MB':>10}{'load ms':>10}"
+            f"{'recall':>9}{'ms/query':>10}"
+        )
+        for name, store_cls, kwargs in configs:
+            with tempfile.TemporaryDirectory() as tmp:
+                persist_path = None
+                disk = None
+                if store_cls is SimpleVectorStore:
+                    persist_path = os.path.join(tmp, "default__vector_store.json")
+                    SimpleVectorStore(data=data).persist(persist_path)
+                elif store_cls is QuantizedVectorStore:
+                    persist_path = os.path.join(tmp, "default__vector_store.json")
+                    QuantizedVectorStore.from_arrays(
+                        SimpleVectorStoreData(), node_ids, vectors, **kwargs
+                    ).persist(persist_path)
+                if persist_path is not None:
+                    disk = dir_size(tmp)
+
+                # a fresh child per store, so memory freed by one store (or by
+                # this process) is not reused by the next and hidden from RSS
+                context = multiprocessing.get_context("spawn")
+                receiver, sender = context.Pipe(duplex=False)
+                child = context.Process(
+                    target=measure_store,
+                    args=(sender, store_cls, persist_path, kwargs, node_ids, vectors, queries, top_k),
+                )
+                child.start()
+                (anon, mapped), load_ms, elapsed, results = receiver.recv()
+                child.join()
+
+            if exact is None:
+                exact = results
+            recall = np.mean(
+                [len(set(got) & set(want)) / len(want) for got, want in zip(results, exact)]
+            )
+            disk_column = "-" if disk is None else f"{disk / 2**20:.2f}"
+            self.stdout.write(
+                f"{name:<14}{anon / 2**20:>9.2f}{mapped / 2**20:>9.2f}"
+                f"{disk_column:>10}{load_ms:>10.1f}"
+                f"{recall:>9.3f}{elapsed:>10.2f}"
+            )
+        self.stdout.write(
+            "anon MB / file MB: growth of the resident set, split into heap "
+            "memory and memory-mapped file pages, from before loading the store "
+            "to after the query loop. The float32 mmap store reads its whole "
+            "file on every coarse pass, float16 / int8 stores keep their codes "
+            "on the heap and only page in the rows they rescore, though the "
+            "kernel may map whole (large) page cache folios around them. File "
+            "pages are page cache the kernel can drop under memory pressure.\n"
+            "disk MB: float16 / int8 stores keep the float32 vectors next to the "
+            "codes for rescoring, so their disk saving is relative to the json "
+            "format only; they are larger than the raw float32 vectors."
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from llama_index.core import StorageContext
+
+from projects.snapshots import SnapshotError, export_snapshot
+from projects.vector_store import load_vector_store
+
+
+class Command(BaseCommand):
+    help = "Export a project's index from ./storage to a single snapshot file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("project", type=int)
+        parser.add_argument(
+            "-o", "--output", help="Snapshot path (default: project_<pk>.snapshot)"
+        )
+        parser.add_argument("--persist-dir", default="./storage")
+
+    def handle(self, *args, **options):
+        pk = options["project"]
+        output = options["output"] or f"project_{pk}.snapshot"
+        storage_context = StorageContext.from_defaults(
+            vector_store=load_vector_store(options["persist_dir"]),
+            persist_dir=options["persist_dir"],
+        )
+        try:
+            export_snapshot(storage_context, pk, output)
+        except SnapshotError as exc:
+            raise CommandError(exc) from exc
+        self.stdout.write(self.style.SUCCESS(f"Exported project {pk} to {output}"))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from projects.snapshots import SnapshotError, install_snapshot, snapshot_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Verify a project snapshot and install it in INDEX_SNAPSHOT_DIR, "
+        "replacing the current one atomically."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("snapshot")
+        parser.add_argument(
+            "--project", type=int, help="Install for this project instead of the exported one"
+        )
+        parser.add_argument(
+            "--force", action="store_true", help="Install even if the installed snapshot is newer"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            pk = install_snapshot(
+                options["snapshot"], pk=options["project"], force=options["force"]
+            )
+        except SnapshotError as exc:
+            raise CommandError(exc) from exc
+        if pk is None:
+            self.stdout.write(
+                self.style.WARNING("A newer snapshot is already installed, use --force to replace it")
+            )
+            return
+        self.stdout.write(self.style.SUCCESS(f"Installed {snapshot_path(pk)}"))
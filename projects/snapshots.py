@@ -0,0 +1,290 @@
+"""Single-file project index snapshots.
+
+A snapshot holds everything ``load_index_from_storage`` needs for one
+project: the index struct, the project's slice of the docstore (in its kv
+layout, so loading it does not re-parse every node), the vector store
+metadata and the embeddings. Layout::
+
+    magic (8s) | version (H) | header length (Q) | sha256 (32s)
+    header json, padded to ALIGNMENT
+    arrays (vectors, norms, plus codes and scales unless the dtype is
+    float32), each aligned to ALIGNMENT
+
+The sha256 covers everything after the fixed prefix. Arrays are
+memory-mapped on load, so opening a snapshot only parses the header json.
+Installed snapshots live in ``settings.INDEX_SNAPSHOT_DIR`` and are replaced
+with ``os.replace``; queries already running keep the old mapping.
+"""
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+from django.conf import settings
+from llama_index.core import StorageContext, load_index_from_storage
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.docstore.keyval_docstore import (
+    DEFAULT_COLLECTION_DATA_SUFFIX,
+    DEFAULT_METADATA_COLLECTION_SUFFIX,
+    DEFAULT_NAMESPACE,
+    DEFAULT_REF_DOC_COLLECTION_SUFFIX,
+)
+from llama_index.core.storage.index_store import SimpleIndexStore
+from llama_index.core.storage.index_store.utils import (
+    index_struct_to_json,
+    json_to_index_struct,
+)
+from llama_index.core.vector_stores.simple import SimpleVectorStoreData
+
+from .vector_store import QuantizedVectorStore, get_vectors, map_array, quantize, store_data
+
+MAGIC = b"SMINDEX\0"
+VERSION = 2
+PREFIX = struct.Struct("<8sHQ32s")
+ALIGNMENT = 64
+NODE_COLLECTION = DEFAULT_NAMESPACE + DEFAULT_COLLECTION_DATA_SUFFIX
+METADATA_COLLECTION = DEFAULT_NAMESPACE + DEFAULT_METADATA_COLLECTION_SUFFIX
+REF_DOC_COLLECTION = DEFAULT_NAMESPACE + DEFAULT_REF_DOC_COLLECTION_SUFFIX
+
+# project pk -> ((inode, mtime, size) of the snapshot file, loaded index)
+_loaded = {}
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _align(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def snapshot_path(pk):
+    return os.path.join(settings.INDEX_SNAPSHOT_DIR, f"project_{pk}.snapshot")
+
+
+def _docstore_payload(docstore, node_ids):
+    """The kv collections of ``docstore`` restricted to ``node_ids``."""
+    collections = docstore.to_dict()
+    node_data = collections.get(NODE_COLLECTION, {})
+    node_metadata = collections.get(METADATA_COLLECTION, {})
+    node_ids = [node_id for node_id in node_ids if node_id in node_data]
+    nodes = {node_id: node_data[node_id] for node_id in node_ids}
+    metadata = {
+        node_id: node_metadata[node_id] for node_id in node_ids if node_id in node_metadata
+    }
+    ref_docs = collections.get(REF_DOC_COLLECTION, {})
+    ref_doc_ids = {info.get("ref_doc_id") for info in metadata.values()} & set(ref_docs)
+    kept = set(node_ids)
+    ref_doc_info = {
+        ref_doc_id: {
+            **ref_docs[ref_doc_id],
+            "node_ids": [
+                node_id for node_id in ref_docs[ref_doc_id]["node_ids"] if node_id in kept
+            ],
+        }
+        for ref_doc_id in ref_doc_ids
+    }
+    return {
+        NODE_COLLECTION: nodes,
+        METADATA_COLLECTION: metadata,
+        REF_DOC_COLLECTION: ref_doc_info,
+    }
+
+
+def export_snapshot(storage_context, pk, path):
+    """Write the index ``pk`` of ``storage_context`` to a snapshot at ``path``."""
+    index_struct = storage_context.index_store.get_index_struct(f"{pk}")
+    if index_struct is None:
+        raise SnapshotError(f"No index found for project {pk}.")
+
+    vector_store = storage_context.vector_store
+    vector_ids = list(index_struct.nodes_dict)
+    data = store_data(vector_store)
+    vectors = get_vectors(vector_store, vector_ids)
+    dtype = settings.VECTOR_STORE_DTYPE
+    arrays = {
+        "vectors": vectors,
+        "norms": QuantizedVectorStore.compute_norms(vectors),
+    }
+    if dtype != "float32":
+        # float32 stores search the vectors directly
+        arrays["codes"], arrays["scales"] = quantize(vectors, dtype)
+
+    offset = 0
+    layout = {}
+    for name, array in arrays.items():
+        layout[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps(
+        {
+            "project": pk,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "dtype": dtype,
+            "index_struct": index_struct_to_json(index_struct),
+            "docstore": _docstore_payload(
+                storage_context.docstore, index_struct.nodes_dict.values()
+            ),
+            "vector_ids": vector_ids,
+            "text_id_to_ref_doc_id": {
+                vector_id: data.text_id_to_ref_doc_id[vector_id]
+                for vector_id in vector_ids
+            },
+            "metadata_dict": {
+                vector_id: (data.metadata_dict or {}).get(vector_id)
+                for vector_id in vector_ids
+            },
+            "arrays": layout,
+        }
+    ).encode()
+
+    digest = hashlib.sha256()
+    with open(path, "wb") as f:
+        f.write(b"\0" * PREFIX.size)
+        padded_header = header.ljust(_align(PREFIX.size + len(header)) - PREFIX.size, b"\0")
+        f.write(padded_header)
+        digest.update(padded_header)
+        for name, array in arrays.items():
+            chunk = np.ascontiguousarray(array).tobytes()
+            chunk = chunk.ljust(_align(len(chunk)), b"\0")
+            f.write(chunk)
+            digest.update(chunk)
+        f.seek(0)
+        f.write(PREFIX.pack(MAGIC, VERSION, len(header), digest.digest()))
+
+
+def read_header(path, verify=False):
+    """Return the header dict of a snapshot, optionally checking its sha256."""
+    with open(path, "rb") as f:
+        prefix = f.read(PREFIX.size)
+        if len(prefix) != PREFIX.size:
+            raise SnapshotError(f"{path} is not an index snapshot.")
+        magic, version, header_len, expected = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is not an index snapshot.")
+        if version != VERSION:
+            raise SnapshotError(
+                f"{path} is snapshot version {version}, expected {VERSION}."
+            )
+        header = f.read(header_len)
+        if verify:
+            f.seek(PREFIX.size)
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+            if digest.digest() != expected:
+                raise SnapshotError(f"{path} failed its checksum.")
+    header = json.loads(header)
+    header["data_offset"] = _align(PREFIX.size + header_len)
+    return header
+
+
+def load_snapshot(path):
+    """Build the project's index from a snapshot, memory-mapping its vectors."""
+    header = read_header(path)
+    arrays = {
+        name: map_array(
+            path,
+            spec["dtype"],
+            tuple(spec["shape"]),
+            offset=header["data_offset"] + spec["offset"],
+            # only float32 stores scan the vectors, the others rescore a few rows
+            random_access=name == "vectors" and settings.VECTOR_STORE_DTYPE != "float32",
+        )
+        for name, spec in header["arrays"].items()
+    }
+
+    docstore = SimpleDocumentStore.from_dict(header["docstore"])
+    index_store = SimpleIndexStore()
+    index_struct = json_to_index_struct(header["index_struct"])
+    index_store.add_index_struct(index_struct)
+    vector_store = QuantizedVectorStore.from_arrays(
+        SimpleVectorStoreData(
+            text_id_to_ref_doc_id=header["text_id_to_ref_doc_id"],
+            metadata_dict=header["metadata_dict"],
+        ),
+        node_ids=header["vector_ids"],
+        vectors=arrays["vectors"],
+        codes=arrays.get("codes") if header["dtype"] == settings.VECTOR_STORE_DTYPE else None,
+        scales=arrays.get("scales"),
+        norms=arrays["norms"],
+        dtype=settings.VECTOR_STORE_DTYPE,
+        rescore_factor=settings.VECTOR_STORE_RESCORE_FACTOR,
+    )
+    storage_context = StorageContext.from_defaults(
+        docstore=docstore, index_store=index_store, vector_store=vector_store
+    )
+    return load_index_from_storage(storage_context)
+
+
+def install_snapshot(path, pk=None, force=False):
+    """Verify ``path`` and atomically make it the snapshot served for its project.
+
+    Returns the project pk, or None when a newer snapshot is already installed
+    and ``force`` is not set.
+    """
+    header = read_header(path, verify=True)
+    pk = header["project"] if pk is None else pk
+    target = snapshot_path(pk)
+    if not force and os.path.exists(target):
+        if read_header(target)["created"] >= header["created"]:
+            return None
+
+    os.makedirs(settings.INDEX_SNAPSHOT_DIR, exist_ok=True)
+    # copy into the snapshot dir first so the rename stays on one filesystem
+    fd, tmp_path = tempfile.mkstemp(dir=settings.INDEX_SNAPSHOT_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp, open(path, "rb") as src:
+            shutil.copyfileobj(src, tmp)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return pk
+
+
+def refresh_snapshot(storage_context, pk):
+    """Re-export an installed snapshot after the project's index changed."""
+    if not os.path.exists(snapshot_path(pk)):
+        return
+    fd, tmp_path = tempfile.mkstemp(dir=settings.INDEX_SNAPSHOT_DIR, suffix=".tmp")
+    os.close(fd)
+    try:
+        export_snapshot(storage_context, pk, tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, snapshot_path(pk))
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_project_index(pk):
+    """Index served from the installed snapshot of a project, if there is one.
+
+    Loaded indexes are cached per process and reloaded when the snapshot file
+    is replaced.
+    """
+    try:
+        stat = os.stat(snapshot_path(pk))
+    except FileNotFoundError:
+        return None
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _loaded.get(pk)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    index = load_snapshot(snapshot_path(pk))
+    _loaded[pk] = (key, index)
+    return index
@@ -1,3 +1,377 @@
-from django.test import TestCase
+import mmap
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+from llama_index.core import (
+    Settings,
+    StorageContext,
+    VectorStoreIndex,
+    load_index_from_storage,
+)
+from llama_index.core.embeddings import MockEmbedding
+from llama_index.core.schema import (
+    NodeRelationship,
+    QueryBundle,
+    RelatedNodeInfo,
+    TextNode,
+)
+from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.storage.index_store import SimpleIndexStore
+from llama_index.core.vector_stores.types import (
+    ExactMatchFilter,
+    MetadataFilters,
+    VectorStoreQuery,
+)
+
+from . import snapshots, vector_store
+from .snapshots import (
+    SnapshotError,
+    export_snapshot,
+    install_snapshot,
+    load_project_index,
+    read_header,
+    snapshot_path,
+)
+from .vector_store import QuantizedVectorStore, load_vector_store, make_vector_store, quantize
+
+
+def random_vectors(count, dim=32, seed=0):
+    return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+
+def make_nodes(vectors, docs=3):
+    return [
+        TextNode(
+            id_=f"node-{i}",
+            text=f"chunk {i}",
+            embedding=vector.tolist(),
+            metadata={"doc": i % docs},
+            relationships={
+                NodeRelationship.SOURCE: RelatedNodeInfo(node_id=f"doc-{i % docs}")
+            },
+        )
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def is_mapped(array):
+    while array is not None and not isinstance(array, (mmap.mmap, np.memmap)):
+        array = array.obj if isinstance(array, memoryview) else array.base
+    return array is not None
+
+
+def exact_top_k(vectors, query, top_k, rows=None):
+    rows = np.arange(len(vectors)) if rows is None else np.asarray(rows)
+    sims = vectors[rows] @ query / (
+        np.linalg.norm(vectors[rows], axis=1) * np.linalg.norm(query)
+    )
+    return [f"node-{rows[i]}" for i in np.argsort(-sims)[:top_k]]
+
+
+class QuantizeTests(SimpleTestCase):
+    def test_int8_codes_and_scales(self):
+        vectors = random_vectors(50)
+        codes, scales = quantize(vectors, "int8")
+        self.assertEqual(codes.dtype, np.int8)
+        self.assertEqual(np.abs(codes).max(axis=1).tolist(), [127] * 50)
+        np.testing.assert_allclose(codes * scales[:, None], vectors, atol=scales.max())
+
+    def test_zero_vector_keeps_unit_scale(self):
+        codes, scales = quantize(np.zeros((1, 8), dtype=np.float32), "int8")
+        self.assertEqual(scales.tolist(), [1.0])
+        self.assertFalse(codes.any())
+
+    def test_float16(self):
+        vectors = random_vectors(10)
+        codes, scales = quantize(vectors, "float16")
+        self.assertEqual(codes.dtype, np.float16)
+        self.assertTrue((scales == 1).all())
+
+    def test_float32_is_not_copied(self):
+        vectors = random_vectors(10)
+        codes, _ = quantize(vectors, "float32")
+        self.assertIs(codes, vectors)
+
+    def test_unsupported_dtype(self):
+        with self.assertRaises(ValueError):
+            quantize(random_vectors(2), "int4")
+
+
+class QuantizedVectorStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.vectors = random_vectors(200)
+        self.queries = random_vectors(10, seed=1)
+
+    def make_store(self, dtype="int8", **kwargs):
+        store = QuantizedVectorStore(dtype=dtype, **kwargs)
+        store.add(make_nodes(self.vectors))
+        return store
+
+    def query(self, store, embedding, top_k=10, **kwargs):
+        return store.query(
+            VectorStoreQuery(
+                query_embedding=embedding.tolist(), similarity_top_k=top_k, **kwargs
+            )
+        )
+
+    def test_rescored_results_match_exact_search(self):
+        for dtype in ("float32", "float16", "int8"):
+            store = self.make_store(dtype)
+            for query in self.queries:
+                result = self.query(store, query)
+                self.assertEqual(result.ids, exact_top_k(self.vectors, query, 10))
+                self.assertEqual(result.similarities, sorted(result.similarities, reverse=True))
+
+    def test_blocked_scoring_matches_single_block(self):
+        store = self.make_store()
+        expected = [self.query(store, query).ids for query in self.queries]
+        with mock.patch.object(vector_store, "BLOCK_ROWS", 7):
+            self.assertEqual([self.query(store, query).ids for query in self.queries], expected)
+
+    def test_metadata_filter_and_node_ids(self):
+        store = self.make_store()
+        query = self.queries[0]
+        filters = MetadataFilters(filters=[ExactMatchFilter(key="doc", value=1)])
+        result = self.query(store, query, filters=filters)
+        self.assertEqual(
+            result.ids, exact_top_k(self.vectors, query, 10, rows=range(1, 200, 3))
+        )
+
+        node_ids = [f"node-{i}" for i in range(0, 200, 5)]
+        result = self.query(store, query, node_ids=node_ids)
+        self.assertEqual(
+            result.ids, exact_top_k(self.vectors, query, 10, rows=range(0, 200, 5))
+        )
+
+        result = self.query(store, query, node_ids=[])
+        self.assertEqual(result.ids, [])
+
+    def test_add_and_delete_keep_rows_aligned(self):
+        store = self.make_store()
+        store.delete("doc-1")
+        kept = [i for i in range(200) if i % 3 != 1]
+        self.assertEqual(store.node_ids, [f"node-{i}" for i in kept])
+        self.assertEqual(len(store.codes), len(kept))
+        self.assertNotIn("node-1", store.to_dict()["text_id_to_ref_doc_id"])
+        np.testing.assert_array_equal(store.get("node-2"), self.vectors[2])
+        self.assertEqual(
+            self.query(store, self.queries[0]).ids,
+            exact_top_k(self.vectors, self.queries[0], 10, rows=kept),
+        )
+
+        # re-adding a node replaces its row instead of duplicating it
+        replacement = make_nodes(random_vectors(3, seed=2))[:1]
+        store.add(replacement)
+        self.assertEqual(store.node_ids.count("node-0"), 1)
+        np.testing.assert_allclose(store.get("node-0"), replacement[0].embedding)
+        self.assertEqual(store.to_dict()["embedding_dict"], {})
+
+    def test_float32_shares_codes_with_vectors(self):
+        store = self.make_store("float32")
+        self.assertIs(store.codes, store.vectors)
+        store.delete("doc-0")
+        self.assertIs(store.codes, store.vectors)
+
+    def test_persist_and_load_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "default__vector_store.json")
+            for dtype in ("float32", "int8"):
+                store = self.make_store(dtype)
+                store.persist(path)
+                loaded = QuantizedVectorStore.from_persist_path(path, dtype=dtype)
+                self.assertTrue(is_mapped(loaded.vectors))
+                self.assertEqual(loaded.node_ids, store.node_ids)
+                for query in self.queries:
+                    self.assertEqual(self.query(loaded, query).ids, self.query(store, query).ids)
+
+                # only the latest generation stays on disk, and float32 stores
+                # do not write their vectors a second time as codes
+                sidecars = sorted(name for name in os.listdir(tmp) if name != "default__vector_store.json")
+                self.assertEqual(len(sidecars), 2)
+                with np.load(os.path.join(tmp, sidecars[0])) as arrays:
+                    self.assertEqual("codes" in arrays, dtype != "float32")
+
+    def test_load_quantizes_plain_json(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "default__vector_store.json")
+            plain = vector_store.SimpleVectorStore()
+            plain.add(make_nodes(self.vectors))
+            plain.persist(path)
+            loaded = QuantizedVectorStore.from_persist_path(path, dtype="int8")
+            self.assertEqual(
+                self.query(loaded, self.queries[0]).ids,
+                exact_top_k(self.vectors, self.queries[0], 10),
+            )
+
+    def test_load_retries_when_generation_is_replaced(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "default__vector_store.json")
+            store = self.make_store()
+            store.persist(path)
+            real_load = np.load
+            calls = []
+
+            def racing_load(file, *args, **kwargs):
+                # a writer swaps in a new generation right after the json was read
+                if not calls:
+                    calls.append(file)
+                    store.persist(path)
+                return real_load(file, *args, **kwargs)
+
+            with mock.patch.object(vector_store.np, "load", racing_load):
+                loaded = QuantizedVectorStore.from_persist_path(path, dtype="int8")
+            self.assertEqual(loaded.node_ids, store.node_ids)
+
+
+class SnapshotTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.persist_dir = os.path.join(tmp.name, "storage")
+        self.exports = os.path.join(tmp.name, "exports")
+        os.makedirs(self.exports)
+        settings_override = override_settings(
+            INDEX_SNAPSHOT_DIR=os.path.join(tmp.name, "snapshots")
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # embeddings are set on the nodes, nothing may call OpenAI
+        Settings.embed_model = MockEmbedding(embed_dim=32)
+        snapshots._loaded.clear()
+
+        self.vectors = random_vectors(60)
+        self.queries = random_vectors(5, seed=1)
+
+    def build_storage(self, nodes=None):
+        storage_context = StorageContext.from_defaults(
+            docstore=SimpleDocumentStore(),
+            vector_store=make_vector_store(),
+            index_store=SimpleIndexStore(),
+        )
+        nodes = make_nodes(self.vectors) if nodes is None else nodes
+        storage_context.docstore.add_documents(nodes)
+        index = VectorStoreIndex(nodes, storage_context=storage_context)
+        index.set_index_id("7")
+        storage_context.persist(persist_dir=self.persist_dir)
+
+    def load_storage(self):
+        return StorageContext.from_defaults(
+            vector_store=load_vector_store(self.persist_dir), persist_dir=self.persist_dir
+        )
+
+    def export(self, name="project_7.snapshot"):
+        path = os.path.join(self.exports, name)
+        export_snapshot(self.load_storage(), 7, path)
+        return path
+
+    def retrieve(self, index, query):
+        retriever = index.as_retriever(similarity_top_k=5)
+        return [
+            result.node.node_id
+            for result in retriever.retrieve(
+                QueryBundle(query_str="", embedding=query.tolist())
+            )
+        ]
+
+    def test_round_trip_matches_storage_index(self):
+        for dtype in ("float32", "int8"):
+            with self.subTest(dtype=dtype), override_settings(VECTOR_STORE_DTYPE=dtype):
+                snapshots._loaded.clear()
+                self.build_storage()
+                self.assertEqual(install_snapshot(self.export(), force=True), 7)
+
+                index = load_project_index(7)
+                self.assertTrue(is_mapped(index.vector_store.vectors))
+                expected = load_index_from_storage(self.load_storage(), index_id="7")
+                for query in self.queries:
+                    self.assertEqual(self.retrieve(index, query), self.retrieve(expected, query))
+                self.assertEqual(
+                    index.docstore.get_node("node-4").text, "chunk 4"
+                )
+
+                arrays = read_header(snapshot_path(7))["arrays"]
+                if dtype == "float32":
+                    # the vectors are stored once and searched directly
+                    self.assertEqual(set(arrays), {"vectors", "norms"})
+                    self.assertIs(index.vector_store.codes, index.vector_store.vectors)
+                else:
+                    self.assertEqual(arrays["codes"]["dtype"], "|i1")
+
+    def test_snapshot_holds_only_the_projects_docstore_slice(self):
+        self.build_storage()
+        storage_context = self.load_storage()
+        other = TextNode(
+            id_="other-node",
+            text="another project",
+            relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id="doc-0")},
+        )
+        storage_context.docstore.add_documents([other])
+        export_snapshot(storage_context, 7, os.path.join(self.exports, "project_7.snapshot"))
+        install_snapshot(os.path.join(self.exports, "project_7.snapshot"))
+
+        docstore = load_project_index(7).docstore
+        self.assertEqual(len(docstore.docs), len(self.vectors))
+        self.assertFalse(docstore.document_exists("other-node"))
+        self.assertNotIn("other-node", docstore.get_ref_doc_info("doc-0").node_ids)
+        self.assertEqual(docstore.get_node("node-3").ref_doc_id, "doc-0")
+
+    def test_export_of_empty_index(self):
+        for dtype in ("float32", "int8"):
+            with self.subTest(dtype=dtype), override_settings(VECTOR_STORE_DTYPE=dtype):
+                snapshots._loaded.clear()
+                self.build_storage(nodes=[])
+                install_snapshot(self.export(), force=True)
+                index = load_project_index(7)
+                self.assertEqual(self.retrieve(index, self.queries[0]), [])
+
+    def test_export_unknown_project(self):
+        self.build_storage()
+        with self.assertRaises(SnapshotError):
+            export_snapshot(self.load_storage(), 8, os.path.join(self.exports, "x"))
+
+    def test_older_snapshot_needs_force(self):
+        self.build_storage()
+        older = self.export("older.snapshot")
+        newer = self.export("newer.snapshot")
+        self.assertEqual(install_snapshot(newer), 7)
+        self.assertIsNone(install_snapshot(older))
+        self.assertEqual(
+            read_header(snapshot_path(7))["created"], read_header(newer)["created"]
+        )
+        self.assertEqual(install_snapshot(older, force=True), 7)
+        self.assertEqual(
+            read_header(snapshot_path(7))["created"], read_header(older)["created"]
+        )
+
+    def test_corrupted_snapshot_is_rejected(self):
+        self.build_storage()
+        path = self.export()
+        with open(path, "r+b") as f:
+            f.seek(-10, os.SEEK_END)
+            f.write(b"corrupted!")
+        with self.assertRaisesRegex(SnapshotError, "checksum"):
+            install_snapshot(path)
+        self.assertFalse(os.path.exists(snapshot_path(7)))
+
+        with open(path, "r+b") as f:
+            f.write(b"NOTINDEX")
+        with self.assertRaisesRegex(SnapshotError, "not an index snapshot"):
+            install_snapshot(path)
+
+    def test_load_project_index_reloads_replaced_snapshot(self):
+        self.assertIsNone(load_project_index(7))
+        self.build_storage()
+        install_snapshot(self.export("first.snapshot"))
+        index = load_project_index(7)
+        self.assertIs(load_project_index(7), index)
+
+        self.build_storage(nodes=make_nodes(self.vectors[:10]))
+        install_snapshot(self.export("second.snapshot"))
+        reloaded = load_project_index(7)
+        self.assertIsNot(reloaded, index)
+        self.assertEqual(len(reloaded.vector_store.node_ids), 10)
+        # the index a running query holds keeps working on the old mapping
+        self.assertEqual(len(self.retrieve(index, self.queries[0])), 5)
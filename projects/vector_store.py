@@ -0,0 +1,421 @@
+"""Vector store that keeps project embeddings quantized in memory.
+
+Embeddings are searched as float16 or int8 codes (int8 uses one scale per
+vector) and the best candidates are rescored against the full precision
+vectors, which are kept in a float32 ``.npy`` file that is memory-mapped on
+load so only the rows being rescored are paged in.
+
+Each persist writes the arrays under a new generation id and then swaps the
+json, which names that generation, into place. A loader therefore always
+opens arrays that match the json it read. The store only persists to the
+local filesystem, the arrays have to be memory-mappable.
+"""
+import json
+import logging
+import mmap
+import os
+import tempfile
+import uuid
+
+import numpy as np
+from django.conf import settings
+from llama_index.core.vector_stores import SimpleVectorStore
+from llama_index.core.vector_stores.simple import (
+    DEFAULT_VECTOR_STORE,
+    NAMESPACE_SEP,
+    SimpleVectorStoreData,
+    _build_metadata_filter_fn,
+)
+from llama_index.core.vector_stores.types import (
+    DEFAULT_PERSIST_DIR,
+    DEFAULT_PERSIST_FNAME,
+    VectorStoreQueryMode,
+    VectorStoreQueryResult,
+)
+
+logger = logging.getLogger(__name__)
+
+DTYPES = ("float32", "float16", "int8")
+GENERATION_KEY = "generation"
+# rows scored per block in the coarse pass, bounds the float32 temporaries
+BLOCK_ROWS = 1024
+
+
+def quantize(vectors, dtype):
+    """Return ``(codes, scales)`` for a float32 matrix of embeddings."""
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported vector dtype: {dtype}")
+    if dtype == "int8":
+        scales = np.abs(vectors).max(axis=1, initial=0.0) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    # float32 "codes" are the vectors themselves, not a copy of them
+    return vectors.astype(dtype, copy=False), np.ones(len(vectors), dtype=np.float32)
+
+
+def _check_local(fs):
+    if fs is not None and "file" not in fs.protocol:
+        raise ValueError("QuantizedVectorStore only supports the local filesystem.")
+
+
+def _read_generation(persist_path):
+    try:
+        with open(persist_path, "rb") as f:
+            return json.load(f).get(GENERATION_KEY)
+    except FileNotFoundError:
+        return None
+
+
+def map_array(path, dtype, shape, offset=0, random_access=False):
+    """Read-only memory map of an array stored at ``offset`` in ``path``.
+
+    With ``random_access`` the kernel is told not to read ahead, so rescoring
+    a few rows only pages in those rows instead of the whole neighbourhood.
+    """
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    if not count:
+        return np.zeros(shape, dtype=dtype)
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if random_access and hasattr(mmap, "MADV_RANDOM"):
+        buffer.madvise(mmap.MADV_RANDOM)
+    return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+def map_npy(path, random_access=False):
+    """``np.load(path, mmap_mode="r")`` that can disable read-ahead."""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if fortran_order:
+        raise ValueError(f"{path} is not a C-ordered array.")
+    return map_array(path, dtype, shape, offset, random_access)
+
+
+def sidecar_paths(persist_path, generation):
+    """Paths of the code and full precision files of one persisted generation."""
+    base, _ = os.path.splitext(persist_path)
+    return f"{base}.{generation}.codes.npz", f"{base}.{generation}.vectors.npy"
+
+
+class QuantizedVectorStore(SimpleVectorStore):
+    """SimpleVectorStore that searches quantized embeddings.
+
+    ``embedding_dict`` stays empty; the ref doc ids and metadata are kept in
+    the usual ``SimpleVectorStoreData`` so filtering and deletes behave as in
+    the parent class.
+    """
+
+    def __init__(self, data=None, fs=None, dtype="int8", rescore_factor=4, **kwargs):
+        _check_local(fs)
+        super().__init__(data=data, fs=fs, **kwargs)
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.dtype = dtype
+        self.rescore_factor = max(1, int(rescore_factor))
+        self._node_ids = []
+        self._rows = {}
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._codes = np.zeros((0, 0), dtype=dtype)
+        self._scales = np.zeros(0, dtype=np.float32)
+        self._norms = np.zeros(0, dtype=np.float32)
+        # migrate any embeddings handed over in plain SimpleVectorStoreData
+        if self._data.embedding_dict:
+            node_ids = list(self._data.embedding_dict)
+            vectors = np.asarray(
+                [self._data.embedding_dict[node_id] for node_id in node_ids],
+                dtype=np.float32,
+            )
+            self._data.embedding_dict = {}
+            self._append(node_ids, vectors)
+
+    @classmethod
+    def from_arrays(cls, data, node_ids, vectors, codes=None, scales=None,
+                    norms=None, dtype="int8", rescore_factor=4):
+        """Build a store from already materialised (or memory-mapped) arrays."""
+        store = cls(data=data, dtype=dtype, rescore_factor=rescore_factor)
+        store._node_ids = list(node_ids)
+        store._rows = {node_id: row for row, node_id in enumerate(store._node_ids)}
+        store._vectors = vectors
+        if dtype == "float32":
+            codes, scales = vectors, np.ones(len(store._node_ids), dtype=np.float32)
+        elif codes is None or codes.dtype != np.dtype(dtype):
+            codes, scales = quantize(np.asarray(vectors, dtype=np.float32), dtype)
+        store._codes, store._scales = codes, scales
+        store._norms = norms if norms is not None else store.compute_norms(vectors)
+        return store
+
+    @property
+    def node_ids(self):
+        """Node ids in row order of ``vectors`` and ``codes``."""
+        return self._node_ids
+
+    @property
+    def vectors(self):
+        """Full precision embeddings, one row per node, used for rescoring."""
+        return self._vectors
+
+    @property
+    def codes(self):
+        """Quantized embeddings searched by the coarse pass."""
+        return self._codes
+
+    def get_vectors(self, node_ids):
+        """float32 matrix of the embeddings of ``node_ids``, in that order."""
+        rows = np.array([self._rows[node_id] for node_id in node_ids], dtype=np.intp)
+        return np.asarray(self._vectors[rows], dtype=np.float32)
+
+    @staticmethod
+    def compute_norms(vectors):
+        norms = np.linalg.norm(vectors, axis=1).astype(np.float32)
+        norms[norms == 0] = 1.0
+        return norms
+
+    def _append(self, node_ids, vectors):
+        codes, scales = quantize(vectors, self.dtype)
+        if self._node_ids:
+            self._vectors = np.concatenate([self._vectors, vectors])
+            if self.dtype != "float32":
+                self._codes = np.concatenate([self._codes, codes])
+            self._scales = np.concatenate([self._scales, scales])
+            self._norms = np.concatenate([self._norms, self.compute_norms(vectors)])
+        else:
+            self._vectors, self._codes, self._scales = vectors, codes, scales
+            self._norms = self.compute_norms(vectors)
+        if self.dtype == "float32":
+            self._codes = self._vectors
+        for node_id in node_ids:
+            self._rows[node_id] = len(self._node_ids)
+            self._node_ids.append(node_id)
+
+    def _remove(self, node_ids):
+        node_ids = set(node_ids) & set(self._rows)
+        if not node_ids:
+            return
+        keep = np.array([node_id not in node_ids for node_id in self._node_ids])
+        self._vectors = np.asarray(self._vectors[keep])
+        self._codes = self._vectors if self.dtype == "float32" else self._codes[keep]
+        self._scales = self._scales[keep]
+        self._norms = self._norms[keep]
+        self._node_ids = [node_id for node_id in self._node_ids if node_id not in node_ids]
+        self._rows = {node_id: row for row, node_id in enumerate(self._node_ids)}
+
+    def get(self, text_id):
+        return self._vectors[self._rows[text_id]].tolist()
+
+    def add(self, nodes, **add_kwargs):
+        node_ids = super().add(nodes, **add_kwargs)
+        vectors = np.asarray(
+            [self._data.embedding_dict.pop(node_id) for node_id in node_ids],
+            dtype=np.float32,
+        )
+        self._remove(node_ids)
+        if node_ids:
+            self._append(node_ids, vectors)
+        return node_ids
+
+    def delete(self, ref_doc_id, **delete_kwargs):
+        text_ids_to_delete = [
+            text_id
+            for text_id, ref_doc_id_ in self._data.text_id_to_ref_doc_id.items()
+            if ref_doc_id == ref_doc_id_
+        ]
+        for text_id in text_ids_to_delete:
+            del self._data.text_id_to_ref_doc_id[text_id]
+            if self._data.metadata_dict is not None:
+                self._data.metadata_dict.pop(text_id, None)
+        self._remove(text_ids_to_delete)
+
+    def query(self, query, **kwargs):
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Invalid query mode for quantized store: {query.mode}")
+
+        candidates = None
+        if query.filters is not None or query.node_ids is not None:
+            query_filter_fn = _build_metadata_filter_fn(
+                lambda node_id: self._data.metadata_dict[node_id], query.filters
+            )
+            available_ids = set(query.node_ids) if query.node_ids is not None else None
+            candidates = np.array(
+                [
+                    row
+                    for row, node_id in enumerate(self._node_ids)
+                    if (available_ids is None or node_id in available_ids)
+                    and query_filter_fn(node_id)
+                ],
+                dtype=np.int64,
+            )
+
+        num_candidates = len(self._node_ids) if candidates is None else len(candidates)
+        if not num_candidates:
+            return VectorStoreQueryResult(similarities=[], ids=[])
+
+        query_embedding = np.asarray(query.query_embedding, dtype=np.float32)
+        query_norm = np.linalg.norm(query_embedding) or 1.0
+        top_k = min(query.similarity_top_k or num_candidates, num_candidates)
+
+        # coarse pass over the quantized codes, a block of rows at a time
+        scores = np.empty(num_candidates, dtype=np.float32)
+        for start in range(0, num_candidates, BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, num_candidates)
+            block = slice(start, stop) if candidates is None else candidates[start:stop]
+            codes = self._codes[block].astype(np.float32, copy=False)
+            scores[start:stop] = (codes @ query_embedding) * (
+                self._scales[block] / self._norms[block]
+            )
+        if candidates is None:
+            candidates = np.arange(num_candidates)
+
+        num_rescore = min(top_k * self.rescore_factor, len(candidates))
+        if num_rescore < len(candidates):
+            best = np.argpartition(-scores, num_rescore - 1)[:num_rescore]
+            candidates = np.sort(candidates[best])
+
+        # exact rescore of the shortlist against full precision vectors
+        exact = (np.asarray(self._vectors[candidates]) @ query_embedding) / (
+            self._norms[candidates] * query_norm
+        )
+        order = np.argsort(-exact, kind="stable")[:top_k]
+        return VectorStoreQueryResult(
+            similarities=[float(exact[i]) for i in order],
+            ids=[self._node_ids[candidates[i]] for i in order],
+        )
+
+    def persist(self, persist_path=os.path.join(DEFAULT_PERSIST_DIR, DEFAULT_PERSIST_FNAME), fs=None):
+        _check_local(fs)
+        dirpath = os.path.dirname(persist_path)
+        os.makedirs(dirpath, exist_ok=True)
+
+        # new files for every generation: the previous ones may be memory-mapped
+        # or about to be opened by a loader that read the previous json
+        replaced = _read_generation(persist_path)
+        generation = uuid.uuid4().hex
+        codes_path, vectors_path = sidecar_paths(persist_path, generation)
+        with open(vectors_path, "wb") as f:
+            np.save(f, np.asarray(self._vectors, dtype=np.float32))
+        arrays = {"scales": self._scales, "norms": self._norms}
+        if self.dtype != "float32":
+            arrays["codes"] = self._codes
+        with open(codes_path, "wb") as f:
+            np.savez(f, node_ids=np.array(self._node_ids, dtype=str), **arrays)
+
+        fd, tmp_path = tempfile.mkstemp(dir=dirpath or ".", suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({**self._data.to_dict(), GENERATION_KEY: generation}, f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, persist_path)
+
+        # only drop the generation this persist replaced: a concurrent persist
+        # may have swapped in its own since, and that one has to stay. Loaders
+        # that already mapped the old files keep them until they close.
+        if replaced is not None and replaced != generation:
+            for path in sidecar_paths(persist_path, replaced):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    @classmethod
+    def from_persist_path(cls, persist_path, fs=None, dtype="int8", rescore_factor=4):
+        _check_local(fs)
+        if not os.path.exists(persist_path):
+            raise ValueError(
+                f"No existing {__name__} found at {persist_path}, skipping load."
+            )
+
+        logger.debug("Loading %s from %s.", __name__, persist_path)
+        for attempt in range(3):
+            with open(persist_path, "rb") as f:
+                data_dict = json.load(f)
+            generation = data_dict.pop(GENERATION_KEY, None)
+            data = SimpleVectorStoreData.from_dict(data_dict)
+            if generation is None:
+                # plain SimpleVectorStore json, quantize it on the way in
+                return cls(data, dtype=dtype, rescore_factor=rescore_factor)
+
+            codes_path, vectors_path = sidecar_paths(persist_path, generation)
+            try:
+                # float32 stores scan the vectors, the others read a few rows
+                vectors = map_npy(vectors_path, random_access=dtype != "float32")
+                with np.load(codes_path) as arrays:
+                    return cls.from_arrays(
+                        data,
+                        node_ids=arrays["node_ids"].tolist(),
+                        vectors=vectors,
+                        codes=arrays["codes"] if "codes" in arrays else None,
+                        scales=arrays["scales"],
+                        norms=arrays["norms"],
+                        dtype=dtype,
+                        rescore_factor=rescore_factor,
+                    )
+            except FileNotFoundError:
+                # a persist replaced this generation after we read the json
+                if attempt == 2:
+                    raise
+        return None
+
+    @classmethod
+    def from_persist_dir(cls, persist_dir=DEFAULT_PERSIST_DIR, namespace=DEFAULT_VECTOR_STORE,
+                         fs=None, dtype="int8", rescore_factor=4):
+        persist_path = os.path.join(
+            persist_dir, f"{namespace}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+        )
+        return cls.from_persist_path(
+            persist_path, fs=fs, dtype=dtype, rescore_factor=rescore_factor
+        )
+
+    @property
+    def nbytes(self):
+        """Bytes held in memory for the coarse search."""
+        return self._codes.nbytes + self._scales.nbytes + self._norms.nbytes
+
+
+def store_data(vector_store):
+    """The ``SimpleVectorStoreData`` behind a simple (or quantized) store."""
+    # SimpleVectorStore exposes its data only through to_dict(), which deep
+    # copies every embedding
+    return vector_store._data  # pylint: disable=protected-access
+
+
+def get_vectors(vector_store, node_ids):
+    """float32 matrix of the embeddings of ``node_ids`` in either store type."""
+    if isinstance(vector_store, QuantizedVectorStore):
+        return vector_store.get_vectors(node_ids)
+    embedding_dict = store_data(vector_store).embedding_dict
+    dim = len(next(iter(embedding_dict.values()), []))
+    return np.array(
+        [embedding_dict[node_id] for node_id in node_ids], dtype=np.float32
+    ).reshape(len(node_ids), dim)
+
+
+def make_vector_store():
+    """Empty vector store using the configured ``VECTOR_STORE_DTYPE``."""
+    if settings.VECTOR_STORE_DTYPE == "float32":
+        return SimpleVectorStore()
+    return QuantizedVectorStore(
+        dtype=settings.VECTOR_STORE_DTYPE,
+        rescore_factor=settings.VECTOR_STORE_RESCORE_FACTOR,
+    )
+
+
+def load_vector_store(persist_dir):
+    """Load the default vector store persisted in ``persist_dir``."""
+    persist_path = os.path.join(
+        persist_dir, f"{DEFAULT_VECTOR_STORE}{NAMESPACE_SEP}{DEFAULT_PERSIST_FNAME}"
+    )
+    if settings.VECTOR_STORE_DTYPE == "float32" and os.path.exists(persist_path):
+        with open(persist_path, "rb") as f:
+            save_dict = json.load(f)
+        if GENERATION_KEY not in save_dict:
+            return SimpleVectorStore.from_dict(save_dict)
+    return QuantizedVectorStore.from_persist_path(
+        persist_path,
+        dtype=settings.VECTOR_STORE_DTYPE,
+        rescore_factor=settings.VECTOR_STORE_RESCORE_FACTOR,
+    )
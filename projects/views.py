@@ -15,10 +15,11 @@ from llama_index.core import (
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.storage.docstore import SimpleDocumentStore
 from llama_index.core.storage.index_store import SimpleIndexStore
-from llama_index.core.vector_stores import SimpleVectorStore
 
 from .forms import ChatForm, DocumentForm, ProjectForm
 from .models import Document, Project
+from .snapshots import load_project_index, refresh_snapshot
+from .vector_store import load_vector_store, make_vector_store
 
 Settings.chunk_size = 512
 
@@ -58,7 +59,7 @@ def project_detail(request, pk):
             try:
                 storage_context = StorageContext.from_defaults(
                     docstore=SimpleDocumentStore(),
-                    vector_store=SimpleVectorStore(),
+                    vector_store=make_vector_store(),
                     index_store=SimpleIndexStore(),
                     persist_dir="./storage",
                 )
@@ -66,7 +67,7 @@ def project_detail(request, pk):
                 # create storage context using default stores
                 storage_context = StorageContext.from_defaults(
                     docstore=SimpleDocumentStore(),
-                    vector_store=SimpleVectorStore(),
+                    vector_store=make_vector_store(),
                     index_store=SimpleIndexStore(),
                 )
 
@@ -77,8 +78,9 @@ def project_detail(request, pk):
             index = VectorStoreIndex(nodes, storage_context=storage_context)
 
             # can also set index_id to save multiple indexes to the same folder
-            index.set_index_id(pk)
+            index.set_index_id(f"{pk}")
             index.storage_context.persist(persist_dir="./storage")
+            refresh_snapshot(index.storage_context, pk)
 
             return redirect(
                 "project_detail", pk=pk
@@ -129,13 +131,18 @@ def chat(request, pk):
         if form.is_valid():
             message = form.cleaned_data["message"]
 
-            # to load index later, make sure you setup the storage context
-            # this will loaded the persisted stores from persist_dir
-            storage_context = StorageContext.from_defaults(persist_dir="./storage")
+            # serve from the installed snapshot when there is one
+            index = load_project_index(pk)
+            if index is None:
+                # to load index later, make sure you setup the storage context
+                # this will loaded the persisted stores from persist_dir
+                storage_context = StorageContext.from_defaults(
+                    vector_store=load_vector_store("./storage"), persist_dir="./storage"
+                )
 
-            # then load the index object
-            # if loading an index from a persist_dir containing multiple indexes
-            index = load_index_from_storage(storage_context, index_id=f"{pk}")
+                # then load the index object
+                # if loading an index from a persist_dir containing multiple indexes
+                index = load_index_from_storage(storage_context, index_id=f"{pk}")
 
             # get chat engine
             chat_engine = index.as_chat_engine(similarity_top_k=10)
@@ -185,9 +192,12 @@ def delete_document(request, project_id, document_id):
         document = get_object_or_404(Document, pk=document_id, project=project)
         document.delete()  # This deletes the document object from the database
         # update index
-        storage_context = StorageContext.from_defaults(persist_dir="./storage")
+        storage_context = StorageContext.from_defaults(
+            vector_store=load_vector_store("./storage"), persist_dir="./storage"
+        )
         index = load_index_from_storage(storage_context, index_id=f"{project_id}")
         index.delete_ref_doc(f"{document_id}")
+        refresh_snapshot(storage_context, project_id)
 
         return HttpResponseRedirect(
             reverse("project_detail", args=[project_id])
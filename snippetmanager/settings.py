@@ -123,6 +123,19 @@ STATIC_URL = '/static/'
 
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 
+# Precision of the embeddings kept by the index: 'float32' (plain json store),
+# 'float16' or 'int8'. Quantized stores rescore the top
+# similarity_top_k * VECTOR_STORE_RESCORE_FACTOR candidates at full precision.
+# They keep the codes in memory and the float32 vectors memory-mapped from a
+# .npy file next to them: much less heap than float32, but more disk than the
+# raw float32 vectors (still far less than the json store).
+VECTOR_STORE_DTYPE = os.environ.get('VECTOR_STORE_DTYPE', 'float32')
+VECTOR_STORE_RESCORE_FACTOR = int(os.environ.get('VECTOR_STORE_RESCORE_FACTOR', 4))
+
+# Where `manage.py import_index` installs project snapshots; chat serves a
+# project from its snapshot when one is installed.
+INDEX_SNAPSHOT_DIR = os.environ.get('INDEX_SNAPSHOT_DIR', os.path.join(BASE_DIR, 'snapshots/'))
+
 # Base url to serve media files
 MEDIA_URL = '/media/'
 # Path where media is stored